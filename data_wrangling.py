@@ -8,14 +8,24 @@ Created on Mon Jun 23 12:48:28 2025
 """
 
 import re
+from collections import namedtuple
 from fastavro import reader
 import pickle
 import numpy as np
 import streamlit as st
 import io
-import json
-import math
-import pandas as pd
+import orjson
+import zstandard as zstd
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import pyarrow.parquet as pq
+from pyarrow import feather
+
+# one decoded block of a measure: sampling frequency, sample values (float32 array) and starting unix tstamp (in us)
+MeasureBlock = namedtuple("MeasureBlock", ["fs", "values", "start_us"])
+
+# the starting tstamp is the last 10 digits before '.avro'
+_TSTAMP_RE = re.compile(r'(\d{10})(?=\.avro$)')
 
 def extract_start_tstamp(filename):
     '''
@@ -30,11 +40,33 @@ def extract_start_tstamp(filename):
     the starting tstamp in int.
 
     '''
-    # Assumes last 10 digits before '.avro' are the number
-    match = re.search(r'(\d{10})(?=\.avro$)', filename)
+    # Empatica files end with '_<10 digits>.avro', which only needs a slice
+    digits = filename[-15:-5]
+    if filename.endswith(".avro") and len(digits) == 10 and digits.isdecimal():
+        return int(digits)
+
+    match = _TSTAMP_RE.search(filename)
     return int(match.group(1)) if match else float('inf')
 
 
+def _fill_tstamps(out, starts, fss, offsets, sizes):
+    '''
+    Function that fills the preallocated time stamp array, block by block: start + arange(n) / fs
+
+    Parameters
+    ----------
+    out : np.ndarray (float64)
+        The preallocated array for all the time stamps.
+    starts, fss : np.ndarray (float64)
+        The starting unix time stamp (in s) and the sampling frequency of each block.
+    offsets, sizes : np.ndarray (int64)
+        The position in 'out' and the number of samples of each block.
+
+    '''
+    for i in range(len(sizes)):
+        off, n = offsets[i], sizes[i]
+        out[off:off + n] = starts[i] + np.arange(n, dtype=np.float64) / fss[i]
+
 
 def reading_avro_files(uploaded_files):
     '''
@@ -48,33 +80,76 @@ def reading_avro_files(uploaded_files):
     Returns
     -------
     raw_datas : python list
-        the data list with each element being a dict that contains the raw data.
+        the data list with each element being a dict that contains the raw data (sorted by starting tstamp).
 
     '''
 
-    # Get all .avro files
-    avro_files = [f for f in uploaded_files if f.name.endswith(".avro")]
-    st.info(f"{len(avro_files)} avro files have been uploaded")
+    # Get all .avro files together with their starting tstamp, in a single pass
+    # (the upload index breaks ties, so the files themselves are never compared)
+    keyed_files = [
+        (extract_start_tstamp(f.name), idx, f)
+        for idx, f in enumerate(uploaded_files) if f.name.endswith(".avro")
+    ]
+    st.info(f"{len(keyed_files)} avro files have been uploaded")
 
     # sort(ascending) the files based on the starting tstamp of the avro file
-    sorted_files = sorted(avro_files, key=lambda f: extract_start_tstamp(f.name))
+    keyed_files.sort()
+    sorted_files = [f for _, _, f in keyed_files]
 
     # read all these avro files and put them into a list
     raw_datas = []
+    read_names = []
 
     for f in sorted_files:
         try:
-            bio = io.BytesIO(f.getvalue())
-            records = list(reader(bio))
+            # UploadedFile is already an in-memory buffer, so decode it in place. The whole file is
+            # decoded before anything is kept, so a corrupt file is dropped entirely and named here
+            f.seek(0)
+            records = list(reader(f))
             raw_datas.extend(records)
-            st.success(f"Read raw data from {f.name}")
+            read_names.append(f.name)
         except Exception as e:
             st.error(f"Failed to read {f.name}: {e}")
 
+    # one summary message instead of one message per file
+    if read_names:
+        st.success("Read raw data from:\n" + "\n".join(f"- {name}" for name in read_names))
+
     return raw_datas
 
 
 
+def _reading_measure_blocks(raw_datas, measure):
+    '''
+    Function that collects rawData.<measure> of the decoded avro records as MeasureBlock's
+
+    Parameters
+    ----------
+    raw_datas : list[dict]
+        Decoded avro records, as returned by reading_avro_files.
+    measure : string
+        The measure to be collected, e.g. 'eda', 'temperature', 'bvp'.
+
+    Returns
+    -------
+    blocks : python list
+        one MeasureBlock per avro record, in file order.
+
+    '''
+    blocks = []
+    for file_idx, raw_data in enumerate(raw_datas):
+        try:
+            meas = raw_data['rawData'][measure]
+            # keep the values as a columnar float32 array
+            values = np.asarray(meas['values'], dtype=np.float32)
+            blocks.append(MeasureBlock(meas['samplingFrequency'], values, meas['timestampStart']))
+        except Exception as e:
+            st.error(f"❌ Failed to extract {measure} from file {file_idx}: {e}")
+
+    return blocks
+
+
+
 def extract_signal_streamlit(raw_datas, measure: str):
     """
     Extract a certain type of signal (EDA, temperature, BVP) from raw data.
@@ -89,120 +164,175 @@ def extract_signal_streamlit(raw_datas, measure: str):
     Returns
     -------
     data_dict : dict
-        Includes sampling frequency list, signal values, and unix time stamps.
+        Includes sampling frequency list, signal values (np.float32 array), and unix time stamps (np.float64 array).
     """
 
+    blocks = _reading_measure_blocks(raw_datas, measure)
+
     fs_combine = []
     data_combine = []
-    tstamp_combine = []
+    starts = []
+    sizes = []
+    gap_messages = []
+    prev_end_unix_s = None
 
-    for file_idx, raw_data in enumerate(raw_datas):
+    for file_idx, blk in enumerate(blocks):
         try:
-            meas_sampfreq = raw_data['rawData'][measure]['samplingFrequency']
-            fs_combine.append(meas_sampfreq)
-
-            meas_data = raw_data['rawData'][measure]['values']
-            data_combine.extend(meas_data)
+            meas_sampfreq = blk.fs
+            meas_data = blk.values
+            meas_start_unix_s = blk.start_us / 1e6
 
-            meas_start_unix = raw_data['rawData'][measure]['timestampStart']
-            meas_start_unix_s = meas_start_unix / 1e6
-            meas_end_unix_s = meas_start_unix_s + (len(meas_data) - 1) / meas_sampfreq
-
-            if tstamp_combine:  # when list is not empty
-                tstamp_diff = round(meas_start_unix_s - tstamp_combine[-1], 3)
-                st.info(
+            if prev_end_unix_s is not None:  # when there are previous time stamps
+                tstamp_diff = round(meas_start_unix_s - prev_end_unix_s, 3)
+                gap_messages.append(
                     f"⏱ Time gap between file {file_idx} and file {file_idx+1}: {tstamp_diff} seconds"
                 )
 
-            meas_tstamps = list(
-                np.linspace(meas_start_unix_s, meas_end_unix_s, num=len(meas_data), endpoint=True)
-            )
-            tstamp_combine.extend(meas_tstamps)
+            fs_combine.append(meas_sampfreq)
+            data_combine.append(meas_data)
+            starts.append(meas_start_unix_s)
+            sizes.append(len(meas_data))
+            if len(meas_data):
+                prev_end_unix_s = meas_start_unix_s + (len(meas_data) - 1) / meas_sampfreq
 
         except Exception as e:
             st.error(f"❌ Failed to extract {measure} from file {file_idx}: {e}")
 
-    st.success(f"✅ Finished {measure.upper()} extraction from {len(raw_datas)} file(s).")
+    # one message for all the time gaps instead of one message per file
+    if gap_messages:
+        st.info("\n".join(f"- {msg}" for msg in gap_messages))
+
+    # the total length is known now, so samples and time stamps are written into preallocated arrays
+    sizes = np.asarray(sizes, dtype=np.int64)
+    offsets = np.zeros_like(sizes)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+    total = int(sizes.sum())
+
+    # samples are stored as one float32 array (avro 'float' values are single precision anyway)
+    samples_combine = np.empty(total, dtype=np.float32)
+    for meas_data, off in zip(data_combine, offsets):
+        samples_combine[off:off + len(meas_data)] = meas_data
+
+    tstamp_combine = np.empty(total, dtype=np.float64)
+    _fill_tstamps(tstamp_combine, np.asarray(starts, dtype=np.float64),
+                  np.asarray(fs_combine, dtype=np.float64), offsets, sizes)
+
+    st.success(f"✅ Finished {measure.upper()} extraction from {len(blocks)} file(s).")
 
     data_dict = {
         "fs": fs_combine,
-        "samples": data_combine,
+        "samples": samples_combine,
         "tstamps": tstamp_combine,
     }
 
     return data_dict
 
 
-def _nan_to_none(x):
-    """Convert NaN/inf to None so JSON is valid."""
-    if isinstance(x, float):
-        if math.isnan(x) or math.isinf(x):
-            return None
-        return x
-    if isinstance(x, list):
-        return [_nan_to_none(v) for v in x]
-    if isinstance(x, dict):
-        return {k: _nan_to_none(v) for k, v in x.items()}
-    return x
-
-class CompactJSONEncoder(json.JSONEncoder):
-    def __init__(self, *args, **kwargs):
-        # force indent for objects but not for arrays
-        kwargs['indent'] = 2
-        kwargs['separators'] = (',', ': ')
-        super().__init__(*args, **kwargs)
-
-    def iterencode(self, o, _one_shot=False):
-        # use the default encoder
-        for s in super().iterencode(o, _one_shot=_one_shot):
-            yield s.replace('\n  [\n    ', ' [') \
-                   .replace('\n    ', ' ') \
-                   .replace('\n  ]', ']')
-
-
-def serialize_data_dict(data_dict: dict, fmt: str, base_name: str = "data"):
+def _write_json(data_dict, sink, chunksize):
+    """Write a dict to sink with orjson: one key per line, each value (list/array) kept on a single line."""
+    sink.write(b'{')
+    for idx, (key, value) in enumerate(data_dict.items()):
+        sink.write(b',\n  ' if idx else b'\n  ')
+        sink.write(orjson.dumps(str(key)) + b': [')
+        # dump the values chunk by chunk (without their brackets), so only one chunk is held as json text;
+        # orjson writes NaN/inf as null itself, so no full-array conversion is needed beforehand
+        for start in range(0, len(value), chunksize):
+            if start:
+                sink.write(b',')
+            sink.write(orjson.dumps(value[start:start + chunksize], option=orjson.OPT_SERIALIZE_NUMPY)[1:-1])
+        sink.write(b']')
+    sink.write(b'\n}')
+
+
+def _arrow_table(data_dict, as_timestamps=False):
+    """Build a two-column arrow table (tstamps, samples) without copying the numpy arrays, 'fs' goes into the metadata."""
+    tstamps = data_dict.get("tstamps", [])
+    if as_timestamps:
+        # unix seconds -> int64 microseconds, so parquet can delta-encode the (nearly) regular time stamps
+        tstamps = pa.array(np.round(np.asarray(tstamps, dtype=np.float64) * 1e6).astype(np.int64),
+                           type=pa.timestamp("us", tz="UTC"))
+    else:
+        tstamps = pa.array(tstamps, type=pa.float64(), from_pandas=True)
+
+    table = pa.table({
+        # from_pandas=True turns NaN into nulls, i.e. empty cells in the CSV like pandas used to write
+        "tstamps": tstamps,
+        "samples": pa.array(data_dict.get("samples", []), type=pa.float32(), from_pandas=True),
+    })
+    return table.replace_schema_metadata({"fs": orjson.dumps(list(data_dict.get("fs", [])))})
+
+
+def serialize_data_dict(data_dict: dict, fmt: str, base_name: str = "data", chunksize: int = 1_000_000,
+                        compress: bool = True):
     """
-    Turn your data_dict {'fs': [...], 'samples': [...], 'tstamps': [...]} into a downloadable file.
+    Turn your data_dict {'fs': [...], 'samples': np.ndarray, 'tstamps': np.ndarray} into a downloadable file.
 
     Parameters
     ----------
     data_dict : dict
         Your extracted measure data.
     fmt : str
-        One of: 'pickle', 'json', 'csv'
+        One of: 'pickle', 'json', 'csv', 'parquet', 'feather'
     base_name : str
         Filename stem without extension.
+    chunksize : int
+        Number of rows formatted at once when writing 'json' or 'csv'.
+    compress : bool
+        Compress 'pickle' and 'json' files with zstd (adds '.zst' to the filename).
 
     Returns
     -------
-    (bytes, filename, mime) : tuple
-        - bytes: the file content ready for download
+    (file, filename, mime) : tuple
+        - file: in-memory binary file (io.BytesIO) with the content, rewound and ready for download
         - filename: suggested filename with extension
         - mime: appropriate MIME type for Streamlit's download_button
     """
     fmt = fmt.lower().strip()
-
-    if fmt == "pickle":
-        blob = pickle.dumps(data_dict, protocol=pickle.HIGHEST_PROTOCOL)
-        return blob, f"{base_name}.pkl", "application/octet-stream"
-
-    if fmt == "json":
-        safe_obj = _nan_to_none(data_dict)
-        blob = json.dumps(
-        safe_obj,
-        ensure_ascii=False,
-        cls=CompactJSONEncoder
-        ).encode("utf-8")
-        return blob, f"{base_name}.json", "application/json"
-
-    if fmt == "csv":
-        # Only keep 'tstamps' and 'samples' as columns (omit 'fs')
-        df = pd.DataFrame({
-            "tstamps": data_dict.get("tstamps", []),
-            "samples": data_dict.get("samples", []),
-        })
-        blob = df.to_csv(index=False).encode("utf-8")
-        return blob, f"{base_name}.csv", "text/csv"
-
-    raise ValueError("Unsupported format. Use 'pickle', 'json', or 'csv'.")
-    
+    # every format is written straight into this file, instead of building intermediate blobs
+    sink = io.BytesIO()
+
+    if fmt in ("pickle", "json"):
+        # with compression, the file is compressed while it is being written
+        out = zstd.ZstdCompressor(level=3, threads=-1).stream_writer(sink, closefd=False) if compress else sink
+
+        if fmt == "pickle":
+            # pinned to protocol 5 (already HIGHEST_PROTOCOL on python 3.8+), so the numpy arrays keep being
+            # written in-band through PickleBuffer and the file loads with a plain pickle.load
+            pickle.dump(data_dict, out, protocol=5)
+            filename, mime = f"{base_name}.pkl", "application/octet-stream"
+        else:
+            _write_json(data_dict, out, chunksize)
+            filename, mime = f"{base_name}.json", "application/json"
+
+        if compress:
+            out.close()
+            filename, mime = f"{filename}.zst", "application/zstd"
+
+    elif fmt == "csv":
+        # Only keep 'tstamps' and 'samples' as columns (omit 'fs'), written by arrow's C++ csv writer
+        sink.write(b"tstamps,samples\n")
+        pacsv.write_csv(_arrow_table(data_dict), sink,
+                        write_options=pacsv.WriteOptions(include_header=False, batch_size=chunksize))
+        filename, mime = f"{base_name}.csv", "text/csv"
+
+    elif fmt == "parquet":
+        # 'fs' is kept in the parquet file metadata, time stamps are stored as UTC timestamps
+        pq.write_table(
+            _arrow_table(data_dict, as_timestamps=True),
+            sink,
+            compression="zstd",
+            use_dictionary=False,
+            column_encoding={"tstamps": "DELTA_BINARY_PACKED", "samples": "BYTE_STREAM_SPLIT"},
+        )
+        filename, mime = f"{base_name}.parquet", "application/vnd.apache.parquet"
+
+    elif fmt == "feather":
+        # 'fs' is kept in the feather file metadata, time stamps are stored as UTC timestamps
+        feather.write_feather(_arrow_table(data_dict, as_timestamps=True), sink, compression="lz4")
+        filename, mime = f"{base_name}.feather", "application/vnd.apache.arrow.file"
+
+    else:
+        raise ValueError("Unsupported format. Use 'pickle', 'json', 'csv', 'parquet', or 'feather'.")
+
+    sink.seek(0)
+    return sink, filename, mime
@@ -52,9 +52,15 @@ measure = st.selectbox(
     placeholder="Select one measure ...",
 )
 
+# create cached data extraction function, keyed on the uploaded data and the measure
+@st.cache_data(show_spinner=True)
+def extract_signal_cached(raw_datas, measure):
+    # call the orginal function
+    return extract_signal_streamlit(raw_datas, measure)
+
 if st.button("Data Extraction", disabled=not uploaded):
-    data_dict = extract_signal_streamlit(raw_datas, measure)
-    if data_dict and (data_dict.get("samples") or data_dict.get("tstamps")):
+    data_dict = extract_signal_cached(raw_datas, measure)
+    if data_dict and (len(data_dict.get("samples", [])) > 0 or len(data_dict.get("tstamps", [])) > 0):
         st.session_state["data_dict"] = data_dict
         st.session_state["extracted_measure"] = measure
 
@@ -68,7 +74,7 @@ data_dict = st.session_state.get("data_dict")
 # Let the user choose the format
 fmt_label = st.selectbox(
     "Choose a file format",
-    ["Pickle (.pkl)", "JSON (.json)", "CSV (.csv)"],
+    ["Pickle (.pkl)", "JSON (.json)", "CSV (.csv)", "Parquet (.parquet)", "Feather (.feather)"],
     index=0,
 )
 
@@ -77,6 +83,8 @@ FMT_KEY = {
     "Pickle (.pkl)": "pickle",
     "JSON (.json)": "json",
     "CSV (.csv)": "csv",
+    "Parquet (.parquet)": "parquet",
+    "Feather (.feather)": "feather",
 }
 
 fmt = FMT_KEY[fmt_label]
@@ -85,6 +93,15 @@ fmt = FMT_KEY[fmt_label]
 default_name = measure
 file_stem = st.text_input("File name (without extension)", value=default_name)
 
+# Offer zstd compression for the formats that are not compressed by themselves
+compress = False
+if fmt in ("pickle", "json"):
+    compress = st.checkbox(
+        "Compress the file with zstd (.zst)",
+        value=True,
+        help="Much smaller downloads, open them with e.g. `zstd -d` or the `zstandard` python package.",
+    )
+
 # Warn about CSV losing 'fs'
 if fmt == "csv":
     st.warning(
@@ -103,12 +120,20 @@ if isinstance(data_dict, dict):
 else:
     has_data = False
 
+# create cached serializing function, so that switching back and forth between formats is instant
+# (the data_dict itself is hashed rather than its id(), since the cache is shared by all sessions;
+# every entry is a full output file, so only a few recent ones are kept and they expire after an hour)
+@st.cache_data(show_spinner=True, max_entries=8, ttl=3600)
+def serialize_cached(data_dict, fmt, file_stem, compress):
+    # call the orginal function
+    return serialize_data_dict(data_dict, fmt, base_name=file_stem, compress=compress)
+
 # downloading data
 if st.button("Prepare file", disabled=not has_data):
     try:
-        blob, filename, mime = serialize_data_dict(locals()["data_dict"], fmt, base_name=file_stem)
+        file_obj, filename, mime = serialize_cached(locals()["data_dict"], fmt, file_stem, compress)
         st.success(f"File ready: {filename}")
-        st.download_button("⬇️ Download", data=blob, file_name=filename, mime=mime)
+        st.download_button("⬇️ Download", data=file_obj, file_name=filename, mime=mime)
     except Exception as e:
         st.error(f"Could not prepare the file: {e}")
 else: